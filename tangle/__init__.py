@@ -0,0 +1,4 @@
+import logging
+
+# library modules only log, leave handler config to the application
+logging.getLogger(__name__).addHandler(logging.NullHandler())
@@ -2,7 +2,7 @@
 import os
 import sys
 import logging
-from multiprocessing import Queue
+from multiprocessing import Pipe, Queue
 
 from tangle.watcher import Watcher
 from tangle.processor import Processor
@@ -31,7 +31,8 @@ if __name__ == "__main__":
     wq = Queue()
     pq = Queue()
 
-    watcher = Watcher(path, wq, sockname=SOCKNAME)
+    wake_r, wake_w = Pipe(duplex=False)
+    watcher = Watcher(path, wq, sockname=SOCKNAME, wake=wake_r)
     processor = Processor(pq, sockname=SOCKNAME, daemon=False)
 
     processor.start()
@@ -47,6 +48,7 @@ if __name__ == "__main__":
     log.info(">>> Stopping child processes")
 
     wq.put(SHUTDOWN)
+    wake_w.send_bytes(b'stop')
     pq.put(SHUTDOWN)
     watcher.join()
     processor.join()
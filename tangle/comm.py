@@ -4,7 +4,7 @@ import os
 import socket
 from selectors import DefaultSelector, EVENT_READ
 from tangle.events import (
-    dump_event, load_event, CREATE_FILE, WRITE, RENAME_FILE, RENAME_DIR
+    dump_event, load_event, CREATE_FILE, WRITE, RENAME_FILE, FD_EVENTS
 )
 
 LOG = logging.getLogger(__name__)
@@ -19,7 +19,7 @@ def send_event(sock, event):
     """
     msg = dump_event(event)
 
-    if event.type in [CREATE_FILE, WRITE, RENAME_FILE, RENAME_DIR]:
+    if event.type in FD_EVENTS:
         anc_data = [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
                      array.array('i', [event.fd]))]
         return sock.sendmsg([msg], anc_data)
@@ -33,14 +33,18 @@ def recv_event(sock, timeout=None):
     as well.
 
     Assumes that LocalEvents are < 4 KB and we're not interrupted.
+
+    If no timeout is given we block directly in `recvmsg(2)`, skipping the
+    set up of a selector, as callers like the Processor have typically
+    already polled the socket for readability.
     """
-    sel = DefaultSelector()
-    sel.register(sock, EVENT_READ)
-    events = sel.select(timeout=timeout)
-    sel.unregister(sock)
-    if len(events) < 1:
-        print('ERR: timeout receiving events!')
-        return None, None
+    if timeout is not None:
+        with DefaultSelector() as sel:
+            sel.register(sock, EVENT_READ)
+            events = sel.select(timeout=timeout)
+        if len(events) < 1:
+            LOG.error('timeout receiving events!')
+            return None, None
 
     fds = array.array('i')
     cmsg_len = socket.CMSG_LEN(2 * fds.itemsize)
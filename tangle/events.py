@@ -35,6 +35,9 @@ STARTED = EventType.started
 STOPPED = EventType.stopped
 SHUTDOWN = EventType.shutdown
 
+# events that hand their file descriptor over the socket
+FD_EVENTS = frozenset((CREATE_FILE, WRITE, RENAME_FILE, RENAME_DIR))
+
 LocalEvent = namedtuple('LocalEvent', ['type', 'inode', 'time', 'name', 'fd'])
 
 def dump_event(event):
@@ -1,21 +1,25 @@
 """
 File watcher for BSD-style systems using kqueue(2)
 """
+import errno
 import logging
 import os
+import resource
 import socket
 from time import sleep
-from collections import namedtuple
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Process
 from queue import Empty
 from select import (
-    kqueue, kevent, KQ_FILTER_VNODE, KQ_EV_ADD, KQ_EV_ENABLE, KQ_EV_CLEAR,
+    kqueue, kevent, KQ_FILTER_VNODE, KQ_FILTER_READ, KQ_EV_ADD, KQ_EV_ENABLE,
+    KQ_EV_CLEAR,
     KQ_NOTE_RENAME, KQ_NOTE_WRITE, KQ_NOTE_DELETE, KQ_NOTE_ATTRIB
 )
 from tangle.comm import send_event
 from tangle.events import (
     StartEv, StopEv, CreateFileEv, CreateDirEv, WriteEv, DeleteEv,
-    RenameFileEv, RenameDirEv
+    RenameFileEv, RenameDirEv, CREATE_FILE, WRITE, DELETE, FD_EVENTS
 )
 
 
@@ -24,12 +28,101 @@ LOG = logging.getLogger(__name__)
 # TODO: move into Watcher class and make configurable
 IGNORE_DIRS = {".git", "CVS", ".svn", ".hg"}
 IGNORE_PATTERNS = {".#"}
+# str.startswith() takes a tuple, checking every pattern in one C call
+_IGNORE_TUPLE = tuple(IGNORE_PATTERNS)
+
+# max number of kevents to reap per call to kqueue.control()
+MAX_EVENTS = 256
+
+# submit staged kevents to the kernel once this many are queued up
+CHANGELIST_FLUSH = 128
+
+# number of threads used to open files while bootstrapping, and how many
+# files they open at a time (keeps us near our fd budget in huge dirs)
+BOOTSTRAP_WORKERS = min(16, (os.cpu_count() or 1) * 2)
+BOOTSTRAP_BATCH = 32
+
+# fd budget for watched files if RLIMIT_NOFILE is unlimited
+DEFAULT_FD_BUDGET = 65536
+
+# macOS won't set an unlimited soft RLIMIT_NOFILE, its OPEN_MAX is the most we
+# can ask for instead
+OPEN_MAX = 10240
+
+# open(2) flags used when opening files and dirs to watch them. Python makes
+# fds non-inheritable anyway, but O_CLOEXEC sets it atomically with the open.
+# O_NOFOLLOW makes opening a symlink fail (ELOOP) rather than watching its
+# target twice. (macOS' O_EVTONLY isn't used: we hand file fds to the
+# Processor to read and list dirs through theirs, neither of which event-only
+# fds are meant for.)
+FILE_OPEN_FLAGS = os.O_RDONLY | os.O_CLOEXEC | os.O_NOFOLLOW
+DIR_OPEN_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC | os.O_NOFOLLOW
+
+# kevent flags/fflags used for every file and dir we watch
+_EV_FLAGS = KQ_EV_ADD | KQ_EV_ENABLE | KQ_EV_CLEAR
+_EV_FFLAGS = KQ_NOTE_RENAME | KQ_NOTE_WRITE | KQ_NOTE_DELETE | KQ_NOTE_ATTRIB
+
+# names for the vnode fflags we watch, in the order we handle them
+_FFLAG_NAMES = (
+    (KQ_NOTE_RENAME, "rename"),
+    (KQ_NOTE_DELETE, "delete"),
+    (KQ_NOTE_WRITE, "write"),
+    (KQ_NOTE_ATTRIB, "attrib"),
+)
 
 
 FileState = namedtuple("FileState", ["fd", "name", "dirs"])
 DirState = namedtuple("DirState", ["fd", "name", "files", "dirs"])
 
 
+def fflag_names(flags):
+    """
+    Decode the vnode fflags of a kevent into a list of action names.
+
+    :param flags: `fflags` of a `select.kevent`
+    :returns: list of names, e.g. `['delete', 'write']`
+    """
+    return [name for mask, name in _FFLAG_NAMES if flags & mask]
+
+
+def raise_fd_limit():
+    """
+    Raise our soft `RLIMIT_NOFILE` as far toward the hard limit as the system
+    allows, as every file and directory we watch holds an open fd.
+
+    :returns: the soft limit now in effect
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == hard:
+        return soft
+    limits = [hard]
+    if hard == resource.RLIM_INFINITY:
+        limits.append(OPEN_MAX)
+    for limit in limits:
+        if soft != resource.RLIM_INFINITY and limit != hard and limit <= soft:
+            break
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+            return limit
+        except (ValueError, OSError):
+            continue
+    return soft
+
+
+def fd_budget():
+    """
+    Work out how many file descriptors we can hold open for watched files
+    and directories, leaving headroom under `RLIMIT_NOFILE` for sockets, the
+    kqueue, etc.
+
+    :returns: max number of files and dirs to watch at once, at least 1
+    """
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return DEFAULT_FD_BUDGET
+    return max(1, int(soft * 0.8) - 16)
+
+
 class Watcher(Process):
     """
     A kqueue specific directory and file watcher, built for BSD-like systems.
@@ -37,24 +130,32 @@ class Watcher(Process):
     Assumptions:
       - We'll use inodes to track files/dirs through modifications
       - Inode generations aren't a thing on our file system for now
-      - Hard and Symbolic links won't be handled for now. Undefined behavior
-        will result if trying to use them.
+      - Symbolic links (other than the root path itself) are skipped
+      - Hard links won't be handled for now. Undefined behavior will result
+        if trying to use them.
       - Closing a file descriptor will delete corresponding kevents
-
-    Known issues:
-      - broken symlinks might break initialization or updates
     """
 
-    def __init__(self, path, parent_queue=None, sockname=None, daemon=True):
+    def __init__(self, path, parent_queue=None, sockname=None, daemon=True,
+                 wake=None):
         super().__init__(daemon=daemon)
         self.path = os.path.abspath(path)
         self.parent_queue = parent_queue
+        # read end of a pipe (e.g. from `multiprocessing.Pipe()`) the parent
+        # writes to when it wants us to stop
+        self.wake = wake
         self.root_fd = None
         self.sockname = sockname
         self.inode_map = {}
         self.changelist = []
+        self.pending = {}
+        self.fd_budget = fd_budget()
+        self.file_lru = OrderedDict()
+        self.evicted = {}
+        self.evictions = 0
+        self.active = frozenset()
         self.die = False
-        # self.kq = kqueue()
+        self.kq = None
 
     @staticmethod
     def new_event(fd, inode):
@@ -67,12 +168,7 @@ class Watcher(Process):
         :param fd: open file descriptor to watch using the event
         :param inode: inode number of the file pointed to by fd
         :returns: new `select.kevent` instance"""
-        return kevent(fd,
-                      filter=KQ_FILTER_VNODE,
-                      flags=KQ_EV_ADD | KQ_EV_ENABLE | KQ_EV_CLEAR,
-                      fflags=KQ_NOTE_RENAME | KQ_NOTE_WRITE | KQ_NOTE_DELETE
-                      | KQ_NOTE_ATTRIB,
-                      udata=inode)
+        return kevent(fd, KQ_FILTER_VNODE, _EV_FLAGS, _EV_FFLAGS, udata=inode)
 
     def register_dir(self, fd, dirname, inode, files=None, dirs=None):
         """
@@ -85,9 +181,10 @@ class Watcher(Process):
         :param fd: file descriptor for the directory to register
         :param dirname: `str` name of the directory
         :param inode: inode number for the directory
-        :param files: list of file inodes known in the directory, default: None
-        :param dirs: list of directory inodes known in the given directory,
-                     default: None
+        :param files: set of file inodes known in the directory, stored as
+                      given (not copied), default: None
+        :param dirs: set of directory inodes known in the given directory,
+                     stored as given (not copied), default: None
         :returns: None
         """
         if files is None:
@@ -97,9 +194,8 @@ class Watcher(Process):
 
         state = DirState(fd, dirname, files, dirs)
         self.inode_map[inode] = state
-        event = self.new_event(fd, inode)
-        self.changelist.append(event)
-        LOG.debug("[registered %d:%s]" % (inode, str(state)))
+        self.add_change(self.new_event(fd, inode))
+        LOG.debug("[registered %d:%s]", inode, state)
 
     def register_file(self, fd, filename, inode, current_dir):
         """
@@ -108,19 +204,48 @@ class Watcher(Process):
         with `kqueue()`. Also add it to the internal `Watcher` state in the
         `self.fd_map` map of files we're watching.
 
+        If we're at our `self.fd_budget`, the least recently active file is
+        evicted first to make room, see `make_room()`.
+
         :param fd: open file descriptor for the file
         :param filename: `str` of the filename
         :param inode: inode number for the file
         :param current_dir: currently known parent directory
         :returns: (inode number, file descriptor)
         """
+        if inode not in self.inode_map:
+            self.make_room()
+        self.file_lru[inode] = True
         state = FileState(fd, filename, current_dir)
         self.inode_map[inode] = state
-        event = self.new_event(fd, inode)
-        self.changelist.append(event)
-        LOG.debug("[registered %d:%s]" % (inode, str(state)))
+        self.add_change(self.new_event(fd, inode))
+        LOG.debug("[registered %d:%s]", inode, state)
         return (inode, fd)
 
+    def add_change(self, event):
+        """
+        Stage a kevent in `self.changelist`. Once `CHANGELIST_FLUSH` of them
+        are queued up they get submitted right away, keeping the kernel's view
+        current during big bursts of registrations (e.g. bootstrap or a
+        `git clone`) instead of waiting for the next pass of the event loop.
+
+        :param event: `select.kevent` to stage
+        :returns: None
+        """
+        self.changelist.append(event)
+        if len(self.changelist) >= CHANGELIST_FLUSH and self.kq is not None:
+            self.submit_changes()
+
+    def submit_changes(self):
+        """
+        Submit all staged kevents to the kernel without waiting on any events.
+
+        :returns: None
+        """
+        if self.changelist:
+            changes, self.changelist = self.changelist, []
+            self.kq.control(changes, 0, 0)
+
     def unregister(self, inode):
         """
         Queues up a de-registration for events on the given file descriptor as
@@ -133,9 +258,69 @@ class Watcher(Process):
             state = self.inode_map[inode]
             os.close(state.fd)
             del self.inode_map[inode]
-            LOG.debug("[unregistered %d:%s]" % (inode, str(state)))
+            self.file_lru.pop(inode, None)
+            LOG.debug("[unregistered %d:%s]", inode, state)
             return state.name
 
+    def make_room(self, count=1):
+        """
+        Evict the least recently active files until `count` more fds fit in
+        our `self.fd_budget`. Every fd we hold counts against it, though only
+        files get evicted.
+
+        Files with events waiting in `self.pending` keep their fd until
+        `flush()` has sent them, and files in `self.active` (those with
+        kevents in the batch being handled) keep theirs until the batch is
+        done, so a big batch can take us over budget until it's flushed.
+
+        :param count: number of fds about to be opened, default: 1
+        :returns: None
+        """
+        excess = len(self.inode_map) + count - self.fd_budget
+        if excess <= 0:
+            return
+
+        victims = []
+        for inode in self.file_lru:
+            if len(victims) == excess:
+                break
+            if inode in self.active:
+                continue
+            if not any((inode, ev_type) in self.pending
+                       for ev_type in FD_EVENTS):
+                victims.append(inode)
+
+        if victims and self.kq is not None:
+            # submit any pending kevents first as the fd numbers may get reused
+            self.submit_changes()
+        for inode in victims:
+            self.evict(inode)
+
+    def evict(self, inode):
+        """
+        Stop watching the given file to stay within our `self.fd_budget`,
+        keeping its last known state in `self.evicted`. Its parent directory
+        still lists the inode, so a rescan of the directory picks the file
+        back up (with a rename) if it was renamed, and sends a delete if it's
+        gone, as does deleting the directory. Writes to it aren't reported
+        while it's evicted.
+
+        A file moved to another directory is picked back up with a rename if
+        its new directory gets rescanned first. If its old one does, it gets
+        a delete and then a create once the new directory is rescanned.
+
+        :param inode: inode of the file to evict
+        :returns: name of the evicted file
+        """
+        if not self.evictions:
+            LOG.warning("Watching more than %d files and dirs, writes to the "
+                        "least recently active files will go unreported. "
+                        "Raise RLIMIT_NOFILE to watch them all.",
+                        self.fd_budget)
+        self.evictions += 1
+        self.evicted[inode] = self.inode_map[inode]
+        return self.unregister(inode)
+
     @staticmethod
     def fstat_by_name(path, is_dir=False, dir_fd=None):
         """
@@ -147,16 +332,55 @@ class Watcher(Process):
         :param dir_fd: file descriptor to use as the basis for resolving path
                        (default: None)
         :returns: tuple of (path, fd, inode)
+        :raises OSError: with `errno.ELOOP` if path is a symlink, as they are
+                         not followed
 
-        TODO: refactor into just getting inode, autoclose fd immediately
-              as this is leaking fd's most likely
+        The returned fd is for the caller to register (or close). Use
+        `inode_for()` when all that's needed is the inode.
         """
-        opts = os.O_RDONLY
-        if is_dir:
-            opts = os.O_RDONLY | os.O_DIRECTORY
-        fd = os.open(path, opts, dir_fd=dir_fd)
-        inode = os.fstat(fd).st_ino
-        return (path, fd, inode)
+        fd = os.open(path, DIR_OPEN_FLAGS if is_dir else FILE_OPEN_FLAGS,
+                     dir_fd=dir_fd)
+        return (path, fd, os.fstat(fd).st_ino)
+
+    @classmethod
+    def open_files(cls, names, dir_fd):
+        """
+        Open a batch of files in a given directory, see `fstat_by_name()`,
+        skipping any symlinks and files gone since they were listed. Runs on
+        bootstrap worker threads, so it must not touch any state.
+
+        :param names: list of file names
+        :param dir_fd: open file descriptor of the containing directory
+        :returns: list of (name, fd, inode) tuples
+        :raises OSError: for any other failure, after closing what the batch
+                         had opened so far
+        """
+        opened = []
+        for name in names:
+            try:
+                opened.append(cls.fstat_by_name(name, dir_fd=dir_fd))
+            except FileNotFoundError:
+                LOG.debug("[possibly moved file: %s]", name)
+            except OSError as e:
+                if e.errno != errno.ELOOP:
+                    for _, fd, _ in opened:
+                        os.close(fd)
+                    raise
+                LOG.debug("[ignoring symlink: %s]", name)
+        return opened
+
+    def register_opened(self, opened, dirname, file_inodes):
+        """
+        Register a batch of files opened by `open_files()`.
+
+        :param opened: `Future` resolving to a list of (name, fd, inode)
+        :param dirname: name of the containing directory
+        :param file_inodes: set of file inodes for the containing directory
+        :returns: None
+        """
+        for name, fd, inode in opened.result():
+            self.register_file(fd, name, inode, dirname)
+            file_inodes.add(inode)
 
     def ignore_file(self, filename):
         """
@@ -165,10 +389,7 @@ class Watcher(Process):
         :param filename: name of file to test
         :returns: True if file should be ignored, otherwise False
         """
-        for pattern in IGNORE_PATTERNS:
-            if filename.startswith(pattern):
-                return True
-        return False
+        return filename.startswith(_IGNORE_TUPLE)
 
     def update_state(self, fd, name, inode):
         """
@@ -180,43 +401,41 @@ class Watcher(Process):
         :param inode: inode number for the file
         :returns: None
         """
-        if inode in self.inode_map:
-            state = self.inode_map[inode]
-            if fd != state.fd:
-                os.close(state.fd)
-                self.changelist.append(self.new_event(fd, inode))
-            if state.name != name:
-                LOG.debug("rename detected %s -> %s" % (state.name, name))
-            self.inode_map[inode] = state._replace(fd=fd, name=name)
+        state = self.inode_map.get(inode)
+        if state is None or (fd == state.fd and name == state.name):
+            # nothing changed, which is the common case on a rescan
+            return
+        if fd != state.fd:
+            os.close(state.fd)
+            self.add_change(self.new_event(fd, inode))
+        if state.name != name:
+            LOG.debug("rename detected %s -> %s", state.name, name)
+        self.inode_map[inode] = state._replace(fd=fd, name=name)
 
-    def inode_for(self, path, is_dir=False, dir_fd=None):
+    def inode_for(self, path, dir_fd=None):
         """
         Get an inode for a given file by its path on the file system, using its
         containing file directory (`dir_fd`) if known.
 
+        A plain `fstatat(2)` is all we need here, there's no point opening
+        (and closing) the file just to ask for its inode. Symlinks aren't
+        followed, matching how we open the files we watch.
+
         :param path: path to the file of interest
-        :param is_idr: boolean flag, True if the file in question is a
-                       directory, default is False if it's a regular file.
         :param dir_fd: open file descriptor to a parent directory to use when
-                       opening the file path
+                       resolving the file path
         :returns: inode number
         """
-        opts = os.O_RDONLY
-        if is_dir:
-            opts = os.O_RDONLY | os.O_DIRECTORY
-        fd = os.open(path, opts, dir_fd=dir_fd)
-        inode = os.fstat(fd).st_ino
-        os.close(fd)
-        return inode
+        return os.stat(path, dir_fd=dir_fd, follow_symlinks=False).st_ino
 
     def rename_dir(self, dir_inode):
         """
         Rename a given directory and its children.
 
         :param dir_inode: inode of directory to rename
-        :returns: new name of directory
+        :returns: new name of directory, or '' if it left its parent
         """
-        fd, name = self.inode_map[dir_inode][:2]
+        name = self.inode_map[dir_inode].name
         parent = os.path.dirname(name)
         new_name = ''
         root, dirs, _, _ = next(os.fwalk(parent, dir_fd=self.root_fd))
@@ -224,124 +443,306 @@ class Watcher(Process):
         # find the new directory name
         for d in dirs:
             path = os.path.join(root, d)
-            inode = self.inode_for(path, is_dir=True, dir_fd=self.root_fd)
+            inode = self.inode_for(path, dir_fd=self.root_fd)
             if dir_inode == inode:
                 new_name = os.path.join(parent, d)
 
-        # inline function for recursively renaming children
-        def rename_children(parent_path, child_inode):
-            fd, name, files, dirs = self.inode_map[child_inode]
-            old_parent, dir_name = os.path.split(name)
-            new_name = os.path.join(parent_path, dir_name)
-            self.inode_map[child_inode] = DirState(fd, new_name, files, dirs)
-            for f_inode in files:
-                state = self.inode_map[f_inode]
-                self.inode_map[f_inode] = state._replace(
-                    dirs=os.path.join(parent_path, state.name)
-                )
-            for child in dirs:
-                rename_children(new_name, child)
-
-        # walk the children, renaming them as we go
         if new_name:
-            for child in self.inode_map[dir_inode].dirs:
-                rename_children(new_name, child)
+            self.move_dir(dir_inode, new_name)
 
         return new_name
 
+    def move_dir(self, dir_inode, new_name):
+        """
+        Point the state of a directory, and of everything below it, at the
+        directory's new path.
+
+        We keep whole paths in our state so finding a name never takes a walk
+        up the tree, which means paying for a move here instead.
+
+        :param dir_inode: inode of the directory that moved
+        :param new_name: new path of the directory
+        :returns: None
+        """
+        stack = [(dir_inode, new_name)]
+        while stack:
+            inode, name = stack.pop()
+            state = self.inode_map[inode]
+            self.inode_map[inode] = state._replace(name=name)
+            for f_inode in state.files:
+                f_state = self.inode_map.get(f_inode)
+                if f_state is not None:  # not if evicted
+                    self.inode_map[f_inode] = f_state._replace(dirs=name)
+            for d_inode in state.dirs:
+                d_state = self.inode_map.get(d_inode)
+                if d_state is not None:
+                    leaf = os.path.basename(d_state.name)
+                    stack.append((d_inode, os.path.join(name, leaf)))
+
     def process_dir(self, dir_inode):
         """
         Handle state changes to directories, finding changes to subdirectories
         as well as any files.
 
-        TODO: This is the meat of the event handling and a great candidate for
-        a refactor.
+        Newly found subdirectories are scanned in turn using an explicit stack
+        rather than recursion, so deep trees appearing at once (e.g. a `git
+        clone`) can't hit the recursion limit.
 
         :param inode: inode number for the target directory
-        :returns: dict containing a summary of adds and deletes, of the
-        format: `{'add': (set(), set()), 'del': (set(), set())}` where each
-        tuple is ordered like: `(<files>, <dirs>)`
+        :returns: tuple of `(file_stats, dir_stats)` for the target directory,
+                  see `scan_dir()`
         """
-        dir_fd = self.inode_map[dir_inode].fd
-        dir_name = self.inode_map[dir_inode].name
+        file_stats, dir_stats, stack = self.scan_dir(dir_inode)
+        while stack:
+            stack.extend(self.scan_dir(stack.pop())[2])
+        return (file_stats, dir_stats)
 
+    def scan_dir(self, dir_inode):
+        """
+        Diff a single directory's contents against our state, updating state
+        for known entries and registering (and announcing) new ones.
+
+        :param dir_inode: inode number for the target directory
+        :returns: tuple of `(file_stats, dir_stats, new_dirs)` where the stats
+                  map inodes to `(name, fd)` for everything found in the
+                  directory and `new_dirs` lists the inodes of newly
+                  registered subdirectories still needing a scan
+        """
+        dir_state = self.inode_map[dir_inode]
+        dir_fd, dir_name = dir_state.fd, dir_state.name
+
+        # we only need a shallow listing, which scandir gives us in one pass
+        # with entry types and inodes coming from the dirent, so entries we
+        # already know about cost no extra syscalls at all
+        files, dirs = [], []
         try:
-            (root, dirs, files, rootfd) = next(os.fwalk(dir_fd=dir_fd))
+            with os.scandir(dir_fd) as entries:
+                for entry in entries:
+                    if entry.is_symlink():
+                        continue
+                    if not entry.is_dir(follow_symlinks=False):
+                        if not self.ignore_file(entry.name):
+                            files.append((entry.name, entry.inode()))
+                    elif entry.name not in IGNORE_DIRS:
+                        dirs.append((entry.name, entry.inode()))
         except FileNotFoundError:
             # race condition? directory may be gone!
-            return (set(), set())
-
-        for i in IGNORE_DIRS:
-            if i in dirs:
-                dirs.remove(i)
+            return ({}, {}, [])
 
         file_stats = {}
         f_inodes = set()
-        for f in files:
-            if not self.ignore_file(f):
+        for name, f_inode in files:
+            evicted = self.evicted.get(f_inode)
+            if f_inode in self.inode_map:
+                fd = self.inode_map[f_inode].fd
+            elif (evicted is not None and evicted.name == name
+                  and f_inode in dir_state.files):
+                # evicted to stay under our fd budget and unchanged since
+                f_inodes.add(f_inode)
+                continue
+            else:
                 try:
-                    name, fd, f_inode = self.fstat_by_name(f, dir_fd=dir_fd)
-                    if f_inode in self.inode_map:
-                        os.close(fd)
-                        fd = self.inode_map[f_inode][0]
-                    file_stats[f_inode] = (name, fd, root)
-                    f_inodes.add(f_inode)
-                    self.update_state(fd, name, f_inode)
+                    _, fd, f_inode = self.fstat_by_name(name, dir_fd=dir_fd)
                 except FileNotFoundError:
-                    # thrown by fstat_by_name()
-                    LOG.debug("[possibly moved file: %s]" % f)
+                    LOG.debug("[possibly moved file: %s]", name)
+                    continue
+                except OSError as e:
+                    # replaced by a symlink since we listed it
+                    if e.errno != errno.ELOOP:
+                        raise
+                    LOG.debug("[ignoring symlink: %s]", name)
+                    continue
+                if f_inode in self.evicted:
+                    # renamed or moved here while evicted, watch it again
+                    del self.evicted[f_inode]
+                    self.register_file(fd, name, f_inode, dir_name)
+                    path = os.path.join(dir_name, name)
+                    self.defer(RenameFileEv(f_inode, path, fd))
+            file_stats[f_inode] = (name, fd)
+            f_inodes.add(f_inode)
+            self.update_state(fd, name, f_inode)
 
         dir_stats = {}
         d_inodes = set()
-        for d in dirs:
-            name, fd, d_inode = self.fstat_by_name(d, is_dir=True,
-                                                   dir_fd=dir_fd)
+        for name, d_inode in dirs:
             if d_inode in self.inode_map:
-                os.close(fd)
-                fd = self.inode_map[d_inode][0]
-            dir_stats[d_inode] = (os.path.join(dir_name, name), fd)
+                fd = self.inode_map[d_inode].fd
+            else:
+                try:
+                    _, fd, d_inode = self.fstat_by_name(name, is_dir=True,
+                                                        dir_fd=dir_fd)
+                except FileNotFoundError:
+                    LOG.debug("[possibly moved dir: %s]", name)
+                    continue
+                except OSError as e:
+                    # replaced by a symlink (or a file) since we listed it, or
+                    # one we can't open (and so can't watch)
+                    if e.errno not in (errno.ELOOP, errno.ENOTDIR,
+                                       errno.EACCES):
+                        raise
+                    LOG.debug("[skipping dir %s: %s]", name, e)
+                    continue
+            path = os.path.join(dir_name, name)
+            dir_stats[d_inode] = (path, fd)
             d_inodes.add(d_inode)
-            self.update_state(fd, os.path.join(dir_name, name), d_inode)
-
-        removed_files = self.inode_map[dir_inode].files.difference(f_inodes)
-        removed_dirs = self.inode_map[dir_inode].dirs.difference(d_inodes)
-        # print("[debug] %s has removed files: %s, dirs: %s"
-        # % (dir_name, removed_files, removed_dirs))
-
-        # remove any moved files, de-reg is handled w/ KQ_NOTE_DELETE's
-        for f_inode in removed_files:
-            self.inode_map[dir_inode].files.remove(f_inode)
-        for d_inode in removed_dirs:
-            self.inode_map[dir_inode].dirs.remove(d_inode)
-
-        new_files = f_inodes.difference(self.inode_map[dir_inode].files)
-        new_dirs = d_inodes.difference(self.inode_map[dir_inode].dirs)
+            state = self.inode_map.get(d_inode)
+            if state is not None and state.name != path:
+                # moved, and what's below it needs to follow along. Its own
+                # NOTE_RENAME may have been handled first and found nothing
+                self.move_dir(d_inode, path)
+                self.defer(RenameDirEv(d_inode, path, fd))
+            self.update_state(fd, path, d_inode)
+
+        # nothing else will tell us an evicted file has gone
+        for f_inode in dir_state.files.difference(f_inodes):
+            evicted = self.evicted.pop(f_inode, None)
+            if evicted is not None:
+                self.defer(DeleteEv(f_inode, evicted.name, evicted.fd))
+
+        # remove any moved files in bulk, de-reg is handled w/ KQ_NOTE_DELETE's
+        dir_state.files.intersection_update(f_inodes)
+        dir_state.dirs.intersection_update(d_inodes)
+
+        new_files = f_inodes.difference(dir_state.files)
+        new_dirs = d_inodes.difference(dir_state.dirs)
+        # anything we just opened without state of our own has to be
+        # registered too, or its fd would leak
+        new_files.update(f for f in file_stats
+                         if f not in self.inode_map and f not in self.evicted)
+        new_dirs.update(d for d in dir_stats if d not in self.inode_map)
 
         # Process net-new dirs and files
         for d_inode in new_dirs:
-            name, fd = dir_stats[d_inode][:2]
-            self.notify(CreateDirEv(d_inode, name, fd))
-            self.register_dir(fd, name, d_inode)
-            self.inode_map[dir_inode].dirs.add(d_inode)
-            self.process_dir(d_inode)
+            name, fd = dir_stats[d_inode]
+            if d_inode not in self.inode_map:
+                self.defer(CreateDirEv(d_inode, name, fd))
+                self.register_dir(fd, name, d_inode)
+            # else moved here from another dir, and already renamed above
+            dir_state.dirs.add(d_inode)
 
         for f_inode in new_files:
-            name, fd = file_stats[f_inode][:2]
-            if f_inode not in self.inode_map:
-                self.notify(CreateFileEv(f_inode, name, fd))
-            self.register_file(fd, name, f_inode, dir_name)
-            self.inode_map[dir_inode].files.add(f_inode)
+            name, fd = file_stats[f_inode]
+            if f_inode in self.inode_map:
+                # moved here from another dir, its kevent still follows it
+                state = self.inode_map[f_inode]
+                self.inode_map[f_inode] = state._replace(dirs=dir_name)
+            elif f_inode in self.evicted:
+                # evicted while registering others during this scan
+                state = self.evicted[f_inode]
+                self.evicted[f_inode] = state._replace(name=name,
+                                                       dirs=dir_name)
+            else:
+                self.defer(CreateFileEv(f_inode, name, fd))
+                self.register_file(fd, name, f_inode, dir_name)
+            dir_state.files.add(f_inode)
+
+        return (file_stats, dir_stats, list(new_dirs))
+
+    def walk(self):
+        """
+        Walk the tree under `self.root_fd` top-down, opening each directory
+        once as we reach it.
+
+        Unlike `os.fwalk()`, which stats every subdirectory and opens each
+        one with a throwaway fd, we take entry types straight from the dirents
+        and hand the open fd over to the caller.
+        Symlinks, ignored files and ignored dirs are skipped.
+
+        :returns: generator of `(path, dir_fd, inode, files, dir_inodes)`
+                  where `files` lists the names of files to watch and
+                  `dir_inodes` is the set of subdirectory inodes, which fills
+                  in as the walk gets to (and manages to open) them
+        """
+        # dirs are only opened once popped, so the fds we hold but haven't
+        # handed over yet never number more than one
+        stack = [('.', None, None, None)]
+        while stack:
+            path, parent_fd, name, parent_dirs = stack.pop()
+            if parent_fd is None:
+                dir_fd = os.dup(self.root_fd)
+            else:
+                try:
+                    dir_fd = os.open(name, DIR_OPEN_FLAGS, dir_fd=parent_fd)
+                except OSError as e:
+                    # gone, or swapped for something we don't follow
+                    LOG.debug("[skipping dir %s: %s]", path, e)
+                    continue
+            inode = os.fstat(dir_fd).st_ino
+            if parent_dirs is not None:
+                parent_dirs.add(inode)
 
-        return (file_stats, dir_stats)
+            files, subdirs = [], []
+            try:
+                with os.scandir(dir_fd) as entries:
+                    for entry in entries:
+                        if entry.is_symlink():
+                            continue
+                        if not entry.is_dir(follow_symlinks=False):
+                            if not self.ignore_file(entry.name):
+                                files.append(entry.name)
+                        elif entry.name not in IGNORE_DIRS:
+                            subdirs.append(entry.name)
+            except FileNotFoundError:
+                # race condition? directory may be gone!
+                pass
+
+            dir_inodes = set()
+            yield (path, dir_fd, inode, files, dir_inodes)
+
+            for name in subdirs:
+                stack.append((os.path.join(path, name), dir_fd, name,
+                              dir_inodes))
 
     def notify(self, event):
         """
         Add the given event to the internal queue.
         """
-        LOG.info(str(event))
+        LOG.info("%s", event)
         # LOG.info('XXX sanity check: %s' % str(os.fstat(event.fd)))
         send_event(self.sock, event)
 
+    def defer(self, event):
+        """
+        Stage the given event in `self.pending` until the current batch of
+        kevents is handled, coalescing it with any staged events for the
+        same inode:
+
+          - repeated events of the same type collapse into the latest one
+          - a write is dropped if the file's creation is already pending
+          - a delete drops any pending or later events that would carry the
+            (now closed) file descriptor, until a new file turns up with the
+            same (reused) inode
+
+        :param event: `LocalEvent` to stage
+        :returns: None
+        """
+        inode = event.inode
+        if event.type == WRITE and (inode, CREATE_FILE) in self.pending:
+            return
+        if (event.type in FD_EVENTS and event.type != CREATE_FILE
+                and (inode, DELETE) in self.pending
+                and (inode, CREATE_FILE) not in self.pending):
+            return
+        if event.type == DELETE:
+            for ev_type in FD_EVENTS:
+                self.pending.pop((inode, ev_type), None)
+        # pop first so the latest event moves to the end of the batch
+        self.pending.pop((inode, event.type), None)
+        self.pending[(inode, event.type)] = event
+
+    def flush(self):
+        """
+        Send all staged events, in the order they were staged, and reset
+        `self.pending`.
+
+        :returns: None
+        """
+        for event in self.pending.values():
+            self.notify(event)
+        self.pending.clear()
+        # the files we had to keep open for their events can go now
+        self.make_room(0)
+
     def connect(self):
         """
         Try to connect to a Processor via a socket
@@ -370,30 +771,55 @@ class Watcher(Process):
         new events as they are returned by the kernel.
         """
         # bootstrap
+        raise_fd_limit()
+        self.fd_budget = fd_budget()
         self.kq = kqueue()
 
-        self.root_fd = os.open(self.path, os.O_RDONLY | os.O_DIRECTORY)
-        for root, dirs, files, rootfd in os.fwalk('.', dir_fd=self.root_fd):
-            for i in IGNORE_DIRS:
-                if i in dirs:
-                    dirs.remove(i)
-                    print("[ignoring %s/%s/]" % (root, i))
-
-            dir_fd = os.dup(rootfd)
-            inode = os.fstat(dir_fd).st_ino
-
-            file_inodes = set()
-            for f in files:
-                if not self.ignore_file(f):
-                    _, fd, f_inode = self.fstat_by_name(f, dir_fd=dir_fd)
-                    self.register_file(fd, f, f_inode, root)
-                    file_inodes.add(f_inode)
-
-            # TODO: this is messy, fix when refactoring self.fstat_by_name()
-            dir_inodes = [self.fstat_by_name(d, is_dir=True, dir_fd=dir_fd)[2]
-                          for d in dirs]
-            self.register_dir(dir_fd, root, inode,
-                              set(file_inodes), set(dir_inodes))
+        # the root itself may well be a symlink, so follow it
+        self.root_fd = os.open(self.path,
+                               os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+        # batches being opened, along with how many fds each may hold
+        opening = deque()
+        in_flight = 0
+        batch_size = min(BOOTSTRAP_BATCH, self.fd_budget)
+
+        def register_oldest():
+            size, args = opening.popleft()
+            self.register_opened(*args)
+            return size
+
+        with ThreadPoolExecutor(max_workers=BOOTSTRAP_WORKERS) as pool:
+            for root, dir_fd, inode, files, dir_inodes in self.walk():
+                # file_inodes fills in as its batches get registered
+                file_inodes = set()
+                self.register_dir(dir_fd, root, inode, file_inodes, dir_inodes)
+
+                # open(2) releases the GIL, so the pool opens files (for this
+                # and the previous few dirs) while we keep walking. Only this
+                # thread touches our state, registering batches as they finish.
+                for i in range(0, len(files), batch_size):
+                    batch = files[i:i + batch_size]
+
+                    # make room for the batch before it's opened, counting the
+                    # fds of batches still in flight against our budget too
+                    while True:
+                        self.make_room(in_flight + len(batch))
+                        held = len(self.inode_map) + in_flight + len(batch)
+                        if held <= self.fd_budget or not opening:
+                            break
+                        in_flight -= register_oldest()
+
+                    opened = pool.submit(self.open_files, batch, dir_fd)
+                    opening.append((len(batch), (opened, root, file_inodes)))
+                    in_flight += len(batch)
+                    if len(opening) > BOOTSTRAP_WORKERS:
+                        in_flight -= register_oldest()
+
+            while opening:
+                register_oldest()
+
+        # register whatever bootstrap left staged before we start waiting
+        self.submit_changes()
 
         if not self.connect():
             LOG.info('Failed to connect to socket %s' % self.sockname)
@@ -402,21 +828,46 @@ class Watcher(Process):
 
         self.notify(StartEv())
 
+        # dispatch on the type of state we hold for the event's inode
+        handlers = {
+            DirState: self.handle_dir_event,
+            FileState: self.handle_file_event,
+        }
+
+        # Block until there's something to do if the parent gave us a pipe
+        # to wake us with when it wants us to stop. Without one, we fall back
+        # to checking the parent queue once a second.
+        waker, timeout = None, None
+        if self.wake is not None:
+            waker = self.wake.fileno()
+            self.changelist.append(kevent(waker, filter=KQ_FILTER_READ,
+                                          flags=KQ_EV_ADD))
+        else:
+            timeout = 1
+
         # main event loop
         while not self.die:
-            # ???: without a timeout, no clean way to break out!
-            events = self.kq.control(self.changelist, 1, 1)
-            self.changelist.clear()
+            # hand the staged kevents off and start a fresh list before
+            # blocking, rather than clearing the list once we're back
+            changes, self.changelist = self.changelist, []
+            events = self.kq.control(changes, MAX_EVENTS, timeout)
+            self.active = {event.udata for event in events}
+            woken = False
             for event in events:
+                if event.ident == waker:
+                    woken = True
+                    continue
                 inode = event.udata
-                state = self.inode_map.get(inode, 0)
-
-                if isinstance(state, DirState):
-                    self.handle_dir_event(event)
-                elif isinstance(state, FileState):
-                    self.handle_file_event(event)
+                handler = handlers.get(type(self.inode_map.get(inode)))
+                if handler:
+                    handler(event)
                 else:
-                    LOG.error("Serious state issue! Unknown inode %s" % inode)
+                    LOG.error("Serious state issue! Unknown inode %s", inode)
+            self.active = frozenset()
+            self.flush()
+            if woken:
+                self.stop()
+                continue
             try:
                 self.parent_queue.get_nowait()
                 self.stop()
@@ -441,30 +892,31 @@ class Watcher(Process):
         inode = event.udata
         flags = event.fflags
         state = self.inode_map[inode]
-        actions = []
 
         if flags & KQ_NOTE_RENAME:
             if event.ident != self.root_fd:
                 new_name = self.rename_dir(inode)
-                self.notify(RenameDirEv(inode, new_name, state.fd))
-                actions.append("rename (%s -> %s)" % (state.name, new_name))
+                # moved out from under its parent, so the new parent's scan
+                # will find it and announce the move
+                if new_name:
+                    self.defer(RenameDirEv(inode, new_name, state.fd))
 
         if flags & KQ_NOTE_DELETE:
+            # watched files get their own kevents, evicted ones don't
+            for f_inode in state.files:
+                evicted = self.evicted.pop(f_inode, None)
+                if evicted is not None:
+                    self.defer(DeleteEv(f_inode, evicted.name, evicted.fd))
             self.unregister(inode)
-            actions.append("delete")
-            self.notify(DeleteEv(inode, state.name, state.fd))
+            self.defer(DeleteEv(inode, state.name, state.fd))
 
         if flags & KQ_NOTE_WRITE:
             if inode in self.inode_map:  # this happens if a delete occurs
-                file_changes, dir_changes = self.process_dir(inode)
-                actions.append("writes (files %d, dirs %d)"
-                               % (len(file_changes), len(dir_changes)))
-            else:  # ???: is this conditional still valid?
-                actions.append("writes ignored (%s)" % str(state.name))
-        if flags & KQ_NOTE_ATTRIB:
-            actions.append("attrib")
-        LOG.debug("[d!%d] (%s) %s@%s - %s" % (inode, hex(flags),
-                                              state.name, state.fd, actions))
+                self.process_dir(inode)
+
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("[d!%d] (%#x) %s@%s - %s", inode, flags,
+                      state.name, state.fd, fflag_names(flags))
 
     def handle_file_event(self, event):
         """
@@ -476,27 +928,27 @@ class Watcher(Process):
         """
         inode = event.udata
         flags = event.fflags
-        actions = []
         state = self.inode_map[inode]
-        path = os.path.join(state.dirs, state.name)
+        self.file_lru.move_to_end(inode)
 
-        if flags & KQ_NOTE_RENAME:
-            self.notify(RenameFileEv(inode, path, state.fd))
-            actions.append("rename")
+        if flags == KQ_NOTE_WRITE:
+            # plain writes are the bulk of what we see, skip the other tests
+            self.defer(WriteEv(inode, state.name, state.fd))
+        else:
+            if flags & KQ_NOTE_RENAME:
+                path = os.path.join(state.dirs, state.name)
+                self.defer(RenameFileEv(inode, path, state.fd))
 
-        if flags & KQ_NOTE_DELETE:
-            self.unregister(inode)
-            self.notify(DeleteEv(inode, state.name, state.fd))
-            actions.append("delete")
+            if flags & KQ_NOTE_DELETE:
+                self.unregister(inode)
+                self.defer(DeleteEv(inode, state.name, state.fd))
 
-        if flags & KQ_NOTE_WRITE:
-            self.notify(WriteEv(inode, state.name, state.fd))
-            actions.append("write")
+            if flags & KQ_NOTE_WRITE:
+                self.defer(WriteEv(inode, state.name, state.fd))
 
-        if flags & KQ_NOTE_ATTRIB:
-            actions.append("attrib")
-        LOG.debug("[f!%d] (%s) %s@%s - %s" % (inode, hex(flags),
-                                              state.name, state.fd, actions))
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("[f!%d] (%#x) %s@%s - %s", inode, flags,
+                      state.name, state.fd, fflag_names(flags))
 
     def stop(self):
         """
@@ -506,11 +958,15 @@ class Watcher(Process):
         :returns: None
         """
         LOG.info("Stopping watcher...")
-        for inode, state in self.inode_map.items():
-            try:
-                os.close(state.fd)
-            except OSError:
-                LOG.warning("[e] couldn't close fd %s" % state.fd)
+        # our fds are mostly handed out densely, so close them a contiguous
+        # run at a time (closerange() is a single close_range(2) where the
+        # platform has it), never touching fds in the gaps that aren't ours
+        fds = sorted(state.fd for state in self.inode_map.values())
+        start = 0
+        for i in range(1, len(fds) + 1):
+            if i == len(fds) or fds[i] != fds[i - 1] + 1:
+                os.closerange(fds[start], fds[i - 1] + 1)
+                start = i
 
         self.die = True
 
@@ -520,7 +976,9 @@ class Watcher(Process):
 
 
 if __name__ == '__main__':
-    from multiprocessing import Queue
+    from logging.handlers import QueueHandler, QueueListener
+    from multiprocessing import Pipe, Queue
+    from queue import SimpleQueue
     import signal
     import sys
 
@@ -532,16 +990,28 @@ if __name__ == '__main__':
         '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     )
     ch.setFormatter(formatter)
-    root.addHandler(ch)
+
+    # keep stdout writes off the event loop: QueueHandler still merges each
+    # record's message on the loop, but the formatter and the write to stdout
+    # run on the listener thread
+    log_queue = SimpleQueue()
+    root.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, ch, respect_handler_level=True)
+    listener.start()
     LOG = logging.getLogger('Watcher')
 
     LOG.info('Initializing processor...')
     q = Queue()
-    watcher = Watcher('./tmp', q, '.sock', daemon=False)
+    wake_r, wake_w = Pipe(duplex=False)
+    watcher = Watcher('./tmp', q, '.sock', daemon=False, wake=wake_r)
 
     def handle_interrupt(signum, frame):
         LOG.info('Interrupting watcher...')
         q.put_nowait('stop please')
+        wake_w.send_bytes(b'stop')
 
     signal.signal(signal.SIGINT, handle_interrupt)
-    watcher.run()
+    try:
+        watcher.run()
+    finally:
+        listener.stop()
@@ -8,14 +8,18 @@ from selectors import DefaultSelector, EVENT_READ
 import shutil
 import socket
 import tempfile
-from multiprocessing import Queue
+from multiprocessing import Pipe, Queue
 from queue import Empty
+from select import (
+    kevent, KQ_NOTE_ATTRIB, KQ_NOTE_DELETE, KQ_NOTE_RENAME, KQ_NOTE_WRITE
+)
 
 from tangle.comm import recv_event
 from tangle.watcher import Watcher
 from tangle.events import (
     SHUTDOWN, STARTED, STOPPED,
-    WRITE, DELETE, RENAME_FILE, RENAME_DIR, CREATE_FILE, CREATE_DIR
+    WRITE, DELETE, RENAME_FILE, RENAME_DIR, CREATE_FILE, CREATE_DIR,
+    CreateFileEv, WriteEv, DeleteEv, RenameFileEv
 )
 
 
@@ -92,6 +96,220 @@ class WatcherUnitTests(unittest.TestCase):
         self.assertEqual({1, 2}, entry.files)
         self.assertEqual({5, 6, 7}, entry.dirs)
 
+    def pending_events(self):
+        return [(ev.type, ev.inode, ev.name)
+                for ev in self.watcher.pending.values()]
+
+    def test_defer_collapses_repeated_events(self):
+        """
+        Repeats of an event type collapse into the latest, which moves to the
+        end of the batch.
+        """
+        self.watcher.defer(WriteEv(1, "a", 10))
+        self.watcher.defer(WriteEv(2, "b", 11))
+        self.watcher.defer(WriteEv(1, "a2", 10))
+        self.assertEqual([(WRITE, 2, "b"), (WRITE, 1, "a2")],
+                         self.pending_events())
+
+    def test_defer_drops_write_after_create(self):
+        """
+        A write to a file whose creation is still pending adds nothing.
+        """
+        self.watcher.defer(CreateFileEv(1, "a", 10))
+        self.watcher.defer(WriteEv(1, "a", 10))
+        self.assertEqual([(CREATE_FILE, 1, "a")], self.pending_events())
+
+    def test_defer_delete_drops_fd_events(self):
+        """
+        A delete drops pending events carrying the file's fd, as well as any
+        that come after it.
+        """
+        self.watcher.defer(CreateFileEv(1, "a", 10))
+        self.watcher.defer(RenameFileEv(1, "b", 10))
+        self.watcher.defer(WriteEv(2, "c", 11))
+        self.watcher.defer(DeleteEv(1, "b", 10))
+        self.watcher.defer(WriteEv(1, "b", 10))
+        self.watcher.defer(RenameFileEv(1, "d", 10))
+        self.assertEqual([(WRITE, 2, "c"), (DELETE, 1, "b")],
+                         self.pending_events())
+
+    def test_defer_create_after_delete_reusing_inode(self):
+        """
+        A new file reusing a deleted file's inode still gets announced, after
+        the delete.
+        """
+        self.watcher.defer(DeleteEv(5, "old", 10))
+        self.watcher.defer(CreateFileEv(5, "new", 12))
+        self.watcher.defer(WriteEv(5, "new", 12))
+        self.assertEqual([(DELETE, 5, "old"), (CREATE_FILE, 5, "new")],
+                         self.pending_events())
+
+    def open_fds(self, count):
+        fds = [os.open(os.devnull, os.O_RDONLY) for _ in range(count)]
+        self.addCleanup(self.watcher.stop)
+        return fds
+
+    def test_register_file_evicts_least_recently_active(self):
+        """
+        Registering a file past our fd budget, which counts dirs too, evicts
+        the file that saw activity least recently.
+        """
+        self.watcher.fd_budget = 3
+        fds = self.open_fds(4)
+        self.watcher.register_dir(fds[0], "dir", 100, {1, 2, 3})
+        self.watcher.register_file(fds[1], "a", 1, "dir")
+        self.watcher.register_file(fds[2], "b", 2, "dir")
+
+        # activity on "a" leaves "b" as the least recently active
+        self.watcher.handle_file_event(
+            kevent(fds[1], fflags=KQ_NOTE_ATTRIB, udata=1))
+        self.watcher.register_file(fds[3], "c", 3, "dir")
+
+        self.assertEqual({100, 1, 3}, set(self.watcher.inode_map))
+        self.assertEqual("b", self.watcher.evicted[2].name)
+        self.assertRaises(OSError, os.fstat, fds[2])
+
+    def test_evict_spares_files_with_pending_events(self):
+        """
+        Files keep their fd while events carrying it are pending, the budget
+        is only caught up with once they're flushed.
+        """
+        self.watcher.fd_budget = 1
+        self.watcher.notify = lambda event: None
+        fds = self.open_fds(2)
+        self.watcher.register_file(fds[0], "a", 1, "dir")
+        self.watcher.defer(CreateFileEv(1, "a", fds[0]))
+        self.watcher.register_file(fds[1], "b", 2, "dir")
+        self.assertEqual({1, 2}, set(self.watcher.inode_map))
+
+        self.watcher.flush()
+        self.assertEqual({2}, set(self.watcher.inode_map))
+        self.assertIn(1, self.watcher.evicted)
+
+    def test_evict_spares_files_with_kevents_in_the_batch(self):
+        """
+        Files with kevents still to be handled in the current batch keep
+        their fd, the budget is caught up with once the batch is flushed.
+        """
+        self.watcher.fd_budget = 1
+        fds = self.open_fds(2)
+        self.watcher.register_file(fds[0], "a", 1, "dir")
+        self.watcher.active = {1}
+        self.watcher.register_file(fds[1], "b", 2, "dir")
+        self.assertEqual({1, 2}, set(self.watcher.inode_map))
+
+        self.watcher.active = frozenset()
+        self.watcher.flush()
+        self.assertEqual({2}, set(self.watcher.inode_map))
+
+    def test_deleting_dir_deletes_its_evicted_files(self):
+        """
+        Evicted files have no kevents of their own, so deleting their
+        directory has to account for them.
+        """
+        self.watcher.fd_budget = 2
+        fds = self.open_fds(3)
+        self.watcher.register_dir(fds[0], "./a", 10, {1, 2})
+        self.watcher.register_file(fds[1], "f", 1, "./a")
+        self.watcher.register_file(fds[2], "g", 2, "./a")
+        self.assertIn(1, self.watcher.evicted)
+
+        self.watcher.handle_dir_event(
+            kevent(fds[0], fflags=KQ_NOTE_DELETE, udata=10))
+        self.assertEqual([(DELETE, 1, "f"), (DELETE, 10, "./a")],
+                         self.pending_events())
+        self.assertEqual({}, self.watcher.evicted)
+
+    def test_move_dir_repoints_everything_below(self):
+        """
+        Moving a directory updates its own path, the paths of nested dirs and
+        the parent dirs of every file under them, skipping evicted files.
+        """
+        self.watcher.register_dir(1, "./a", 10, {1}, {11})
+        self.watcher.register_dir(2, "./a/b", 11, {2, 4}, {12})
+        self.watcher.register_dir(3, "./a/b/c", 12, {3})
+        self.watcher.register_file(4, "f", 1, "./a")
+        self.watcher.register_file(5, "g", 2, "./a/b")
+        self.watcher.register_file(6, "h", 3, "./a/b/c")
+
+        self.watcher.move_dir(10, "./x/z")
+
+        inode_map = self.watcher.inode_map
+        self.assertEqual("./x/z", inode_map[10].name)
+        self.assertEqual("./x/z/b", inode_map[11].name)
+        self.assertEqual("./x/z/b/c", inode_map[12].name)
+        self.assertEqual("f", inode_map[1].name)
+        self.assertEqual("./x/z", inode_map[1].dirs)
+        self.assertEqual("./x/z/b", inode_map[2].dirs)
+        self.assertEqual("./x/z/b/c", inode_map[3].dirs)
+        self.assertNotIn(4, inode_map)
+
+    def test_walk_skips_ignored_entries_and_symlinks(self):
+        """
+        Walking yields every watched dir with its files and the inodes of the
+        subdirs it managed to open, pruning ignored dirs and skipping ignored
+        files and symlinks.
+        """
+        root = self.tempdir.name
+        for d in ("a", "a/b", ".git", ".git/objects"):
+            os.mkdir(os.path.join(root, d))
+        for f in ("top", ".#top", "a/f", "a/b/g", ".git/HEAD"):
+            open(os.path.join(root, f), "w").close()
+        os.symlink("top", os.path.join(root, "link"))
+        os.symlink("a", os.path.join(root, "dirlink"))
+
+        self.watcher.root_fd = os.open(root, os.O_RDONLY | os.O_DIRECTORY)
+        self.addCleanup(os.close, self.watcher.root_fd)
+        walked = {}
+        for path, dir_fd, inode, files, dir_inodes in self.watcher.walk():
+            # subdirs get opened relative to it, so keep it open for now
+            self.addCleanup(os.close, dir_fd)
+            walked[path] = (inode, files, dir_inodes)
+
+        def inode(path):
+            return os.stat(os.path.join(root, path)).st_ino
+
+        self.assertEqual({".", "./a", "./a/b"}, set(walked))
+        self.assertEqual((inode("."), ["top"], {inode("a")}), walked["."])
+        self.assertEqual((inode("a"), ["f"], {inode("a/b")}), walked["./a"])
+        self.assertEqual((inode("a/b"), ["g"], set()), walked["./a/b"])
+
+    def test_moving_dir_to_another_parent(self):
+        """
+        A directory moved to a new parent gets renamed to its new path, even
+        when its own rename kevent is handled before the new parent's.
+        """
+        root = self.tempdir.name
+        for d in ("a", "b", "a/m"):
+            os.mkdir(os.path.join(root, d))
+        fds = {}
+        for d in (".", "a", "b", "a/m"):
+            fds[d] = os.open(os.path.join(root, d),
+                             os.O_RDONLY | os.O_DIRECTORY)
+        self.addCleanup(self.watcher.stop)
+        self.watcher.root_fd = fds["."]
+        inode = {d: os.fstat(fd).st_ino for d, fd in fds.items()}
+
+        self.watcher.register_dir(fds["."], ".", inode["."], set(),
+                                  {inode["a"], inode["b"]})
+        self.watcher.register_dir(fds["a"], "./a", inode["a"], set(),
+                                  {inode["a/m"]})
+        self.watcher.register_dir(fds["b"], "./b", inode["b"])
+        self.watcher.register_dir(fds["a/m"], "./a/m", inode["a/m"])
+
+        os.rename(os.path.join(root, "a/m"), os.path.join(root, "b/m"))
+        for d, flags in (("a/m", KQ_NOTE_RENAME), ("b", KQ_NOTE_WRITE),
+                         ("a", KQ_NOTE_WRITE)):
+            self.watcher.handle_dir_event(
+                kevent(fds[d], fflags=flags, udata=inode[d]))
+
+        self.assertEqual([(RENAME_DIR, inode["a/m"], "./b/m")],
+                         self.pending_events())
+        self.assertEqual("./b/m", self.watcher.inode_map[inode["a/m"]].name)
+        self.assertEqual(set(), self.watcher.inode_map[inode["a"]].dirs)
+        self.assertEqual({inode["a/m"]},
+                         self.watcher.inode_map[inode["b"]].dirs)
+
     def test_nothing(self):
         self.tempdir.cleanup()
 
@@ -105,14 +323,24 @@ class WatcherIntegrationTests(unittest.TestCase):
     """
     QUEUE_WAIT = float(os.environ.get("PYTHON_TEST_QUEUE_WAIT", "5"))
 
+    @classmethod
+    def setUpClass(cls):
+        # share one staging root across tests, each test gets its own subdir
+        cls.root = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root, ignore_errors=True)
+
     def setUp(self):
         self.sockfile = tempfile.NamedTemporaryFile()
         self.sockfile.close()
 
-        self.tmpdir = tempfile.TemporaryDirectory()
-        self.tmpsubdir = tempfile.TemporaryDirectory(dir=self.tmpdir.name)
-        self.tmpdir_inode = os.stat(self.tmpdir.name).st_ino
-        self.tmpsubdir_inode = os.stat(self.tmpsubdir.name).st_ino
+        # plain dirs under the shared root, which tearDownClass removes
+        self.tmpdir = os.path.join(self.root, self._testMethodName)
+        self.tmpsubdir = os.path.join(self.tmpdir, 'subdir')
+        os.mkdir(self.tmpdir)
+        os.mkdir(self.tmpsubdir)
 
         self.socket = socket.socket(family=socket.AF_UNIX)
         self.socket.bind(self.sockfile.name)
@@ -120,18 +348,18 @@ class WatcherIntegrationTests(unittest.TestCase):
 
         self.msg_queue = Queue()
         self.parent_queue = Queue()
+        self.wake_r, self.wake_w = Pipe(duplex=False)
         print('Creating Watcher with socket file: %s' % self.sockfile.name)
-        self.watcher = Watcher(self.tmpdir.name,
+        self.watcher = Watcher(self.tmpdir,
                                sockname=self.sockfile.name,
-                               parent_queue=self.parent_queue)
+                               parent_queue=self.parent_queue,
+                               wake=self.wake_r)
 
     def tearDown(self):
-        self.tmpsubdir.cleanup()
-        self.tmpdir.cleanup()
         self.socket.close()
 
     def abs_tmppath(self, relpath):
-        path = os.path.join(self.tmpdir.name, relpath)
+        path = os.path.join(self.tmpdir, relpath)
         path = os.path.abspath(os.path.realpath(os.path.join(path)))
 
         if os.uname()[0] == 'Darwin' and path.startswith('/private'):
@@ -150,8 +378,18 @@ class WatcherIntegrationTests(unittest.TestCase):
             self.fail("Timeout polling Watcher event queue (timeout: %d)"
                       % timeout)
 
+    def create_file(self, dirname, filename):
+        """
+        Create an empty file without the overhead of tempfile's name
+        generation, returning the open fd and the file's path.
+        """
+        path = os.path.join(dirname, filename)
+        fd = os.open(path, os.O_CREAT | os.O_WRONLY | os.O_CLOEXEC, 0o600)
+        return fd, path
+
     def stop_watcher(self):
         self.parent_queue.put(SHUTDOWN)
+        self.wake_w.send_bytes(b'stop')
 
     def assertEvent(self, event, exp_type, exp_inode=None, exp_name=None):
         self.assertEqual(exp_type, event.type)
@@ -182,29 +420,29 @@ class WatcherIntegrationTests(unittest.TestCase):
 
         self.assertEqual(STARTED, self.poll(conn).type)
 
-        f1 = tempfile.NamedTemporaryFile(dir=self.tmpdir.name)
-        f1_inode = os.stat(f1.name).st_ino
-        f2 = tempfile.NamedTemporaryFile(dir=self.tmpsubdir.name)
-        f2_inode = os.stat(f2.name).st_ino
+        f1, f1_name = self.create_file(self.tmpdir, 'f1')
+        f1_inode = os.fstat(f1).st_ino
+        f2, f2_name = self.create_file(self.tmpsubdir, 'f2')
+        f2_inode = os.fstat(f2).st_ino
 
         self.assertEvent(self.poll(conn),
-                         CREATE_FILE, f1_inode, os.path.basename(f1.name))
+                         CREATE_FILE, f1_inode, os.path.basename(f1_name))
         self.assertEvent(self.poll(conn),
-                         CREATE_FILE, f2_inode, os.path.basename(f2.name))
+                         CREATE_FILE, f2_inode, os.path.basename(f2_name))
 
         self.stop_watcher()
         self.assertEqual(STOPPED, self.poll(conn).type)
 
         conn.close()
-        f1.close()
-        f2.close()
+        os.close(f1)
+        os.close(f2)
 
     def test_can_detect_deleting_files(self):
         """
         Deleting files should remove them from the file and directory states.
         """
-        f1 = tempfile.NamedTemporaryFile(dir=self.tmpdir.name)
-        f2 = tempfile.NamedTemporaryFile(dir=self.tmpsubdir.name)
+        f1 = tempfile.NamedTemporaryFile(dir=self.tmpdir)
+        f2 = tempfile.NamedTemporaryFile(dir=self.tmpsubdir)
 
         conn = self.start_watcher()
         self.assertEqual(STARTED, self.poll(conn).type)
@@ -227,17 +465,17 @@ class WatcherIntegrationTests(unittest.TestCase):
         """
         Can we rename a file and appropriately update the state maps?
         """
-        f = open(os.path.join(self.tmpdir.name, 'before'), 'a')
+        f = open(os.path.join(self.tmpdir, 'before'), 'a')
 
         conn = self.start_watcher()
         self.assertEqual(STARTED, self.poll(conn).type)
 
-        os.rename(os.path.join(self.tmpdir.name, 'before'),
-                  os.path.join(self.tmpdir.name, 'after'))
+        os.rename(os.path.join(self.tmpdir, 'before'),
+                  os.path.join(self.tmpdir, 'after'))
         ev = self.poll(conn)
 
         self.assertEqual(RENAME_FILE, ev.type)
-        self.assertEqual(os.path.join(self.tmpdir.name, 'after'),
+        self.assertEqual(os.path.join(self.tmpdir, 'after'),
                          self.abs_tmppath(ev.name))
 
         self.stop_watcher()
@@ -252,12 +490,12 @@ class WatcherIntegrationTests(unittest.TestCase):
         Turns out this really results in a CREATE event where we get
         a new inode and everything.
         """
-        f = tempfile.NamedTemporaryFile(dir=self.tmpdir.name)
+        f = tempfile.NamedTemporaryFile(dir=self.tmpdir)
 
         conn = self.start_watcher()
         self.assertEqual(STARTED, self.poll(conn).type)
 
-        shutil.copy(f.name, os.path.join(self.tmpdir.name, "a_copy"))
+        shutil.copy(f.name, os.path.join(self.tmpdir, "a_copy"))
 
         ev = self.poll(conn)
         self.assertEqual(CREATE_FILE, ev.type)
@@ -267,27 +505,27 @@ class WatcherIntegrationTests(unittest.TestCase):
         """
         Can we detect moving files between directories and keeping state?
         """
-        f = open(os.path.join(self.tmpdir.name, 'tango'), 'a')
+        f = open(os.path.join(self.tmpdir, 'tango'), 'a')
 
         conn = self.start_watcher()
         self.assertEqual(STARTED, self.poll(conn).type)
 
-        os.rename(os.path.join(self.tmpdir.name, 'tango'),
-                  os.path.join(self.tmpsubdir.name, 'tango'))
+        os.rename(os.path.join(self.tmpdir, 'tango'),
+                  os.path.join(self.tmpsubdir, 'tango'))
         ev = self.poll(conn)
 
         self.assertEqual(RENAME_FILE, ev.type)
-        self.assertEqual(os.path.join(self.tmpsubdir.name, 'tango'),
+        self.assertEqual(os.path.join(self.tmpsubdir, 'tango'),
                          self.abs_tmppath(ev.name))
 
         # now move it back! turns out depending on "direction" the underlying
         # kernel events might happen differently
-        os.rename(os.path.join(self.tmpsubdir.name, 'tango'),
-                  os.path.join(self.tmpdir.name, 'tango'))
+        os.rename(os.path.join(self.tmpsubdir, 'tango'),
+                  os.path.join(self.tmpdir, 'tango'))
         ev = self.poll(conn)
 
         self.assertEqual(RENAME_FILE, ev.type)
-        self.assertEqual(os.path.join(self.tmpdir.name, 'tango'),
+        self.assertEqual(os.path.join(self.tmpdir, 'tango'),
                          self.abs_tmppath(ev.name))
 
         self.stop_watcher()
@@ -299,13 +537,13 @@ class WatcherIntegrationTests(unittest.TestCase):
         """
         Can we detect a directory delete and handle deleting subdir content?
         """
-        f = open(os.path.join(self.tmpsubdir.name, 'junk'), 'a')
+        f = open(os.path.join(self.tmpsubdir, 'junk'), 'a')
         f.close()
 
         conn = self.start_watcher()
         self.assertEqual(STARTED, self.poll(conn).type)
 
-        self.tmpsubdir.cleanup()
+        shutil.rmtree(self.tmpsubdir)
 
         ev = self.poll(conn)
         self.assertEqual(DELETE, ev.type)
@@ -322,19 +560,19 @@ class WatcherIntegrationTests(unittest.TestCase):
 
         This one is a bit complex as we store some relative path details.
         """
-        with tempfile.TemporaryDirectory(dir=self.tmpsubdir.name) as subsubdir:
+        with tempfile.TemporaryDirectory(dir=self.tmpsubdir) as subsubdir:
             new_name = 'junkdir'
 
             f = open(os.path.join(subsubdir, 'junkfile'), 'a')
             conn = self.start_watcher()
             self.assertEqual(STARTED, self.poll(conn).type)
 
-            # note: this doesn't update the TemporaryDirectory instance
-            os.rename(self.tmpsubdir.name,
-                      os.path.join(self.tmpdir.name, new_name))
+            # note: this moves subsubdir out from under its TemporaryDirectory
+            os.rename(self.tmpsubdir,
+                      os.path.join(self.tmpdir, new_name))
             ev = self.poll(conn)
             self.assertEqual(RENAME_DIR, ev.type)
-            self.assertEqual(os.path.join(self.tmpdir.name, new_name),
+            self.assertEqual(os.path.join(self.tmpdir, new_name),
                              self.abs_tmppath(ev.name))
 
             self.stop_watcher()
@@ -343,11 +581,11 @@ class WatcherIntegrationTests(unittest.TestCase):
             f.close()
             conn.close()
             # reset so the cleanup routine succeeds.
-            os.rename(os.path.join(self.tmpdir.name, new_name),
-                      self.tmpsubdir.name)
+            os.rename(os.path.join(self.tmpdir, new_name),
+                      self.tmpsubdir)
 
     def test_can_detect_file_writes(self):
-        with open(os.path.join(self.tmpdir.name, "junk"), "a") as f:
+        with open(os.path.join(self.tmpdir, "junk"), "a") as f:
             inode = os.stat(f.fileno()).st_ino
 
             conn = self.start_watcher()
@@ -368,7 +606,7 @@ class WatcherIntegrationTests(unittest.TestCase):
         conn = self.start_watcher()
         self.assertEqual(STARTED, self.poll(conn).type)
 
-        path = os.path.join(self.tmpdir.name, 'junkdir')
+        path = os.path.join(self.tmpdir, 'junkdir')
         os.mkdir(path)
 
         ev = self.poll(conn)